@@ -62,11 +62,19 @@ _C.MODEL = CfgNode()
 _C.MODEL.G_CONV_DIM = 64
 _C.MODEL.D_CONV_DIM = 64
 _C.MODEL.G_REPEAT_NUM = 6
+_C.MODEL.G_UPSAMPLE = "deconv"  # "deconv" or "nearest", must match the loaded weights
 _C.MODEL.D_REPEAT_NUM = 3
 _C.MODEL.NORM = "SN"
 _C.MODEL.WEIGHTS = "assets/models"
 
 
+# Inference
+_C.INFERENCE = CfgNode()
+_C.INFERENCE.COMPILE = True  # torch.compile the generator on cuda when available
+_C.INFERENCE.AMP = True  # bfloat16 autocast on supporting gpus, the attention stays in fp32
+_C.INFERENCE.CUDA_GRAPH = True  # replay a captured cuda graph when not compiled
+
+
 # Preprocessing
 _C.PREPROCESS = CfgNode()
 _C.PREPROCESS.UP_RATIO = 0.6 / 0.85  # delta_size / face_size
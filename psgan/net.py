@@ -1,16 +1,30 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 import math
+import re
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.hub import load_state_dict_from_url
 from torchvision.models import VGG as TVGG
-from torchvision.models.vgg import load_state_dict_from_url, model_urls, cfgs
+from torchvision.models.vgg import cfgs
 
 from ops.spectral_norm import spectral_norm as SpectralNorm
 from concern.track import Track
 
+# scaled_dot_product_attention accepts `scale` from torch 2.1 on
+_USE_SDPA = hasattr(F, "scaled_dot_product_attention") and \
+    tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
+
+def instance_norm(num_features, affine=False):
+    """Build an instance norm as an nn.GroupNorm with one channel per group.
+    Same math and parameter names as nn.InstanceNorm2d, but GroupNorm has
+    channels_last kernels.
+    """
+    return nn.GroupNorm(num_features, num_features, affine=affine)
+
 
 # Defines the GAN loss which uses either LSGAN or the regular GAN.
 # When LSGAN is used, it is basically same as MSELoss,
@@ -27,14 +41,18 @@ class ResidualBlock(nn.Module):
         super(ResidualBlock, self).__init__()
         self.main = nn.Sequential(
             nn.Conv2d(dim_in, dim_out, kernel_size=3, stride=1, padding=1, bias=False),
-            nn.InstanceNorm2d(dim_out, affine=use_affine),
+            instance_norm(dim_out, affine=use_affine),
             nn.ReLU(inplace=True),
             nn.Conv2d(dim_out, dim_out, kernel_size=3, stride=1, padding=1, bias=False),
-            nn.InstanceNorm2d(dim_out, affine=use_affine)
+            instance_norm(dim_out, affine=use_affine)
         )
 
     def forward(self, x):
-        return x + self.main(x)
+        # add the skip into main's fresh output instead of allocating another tensor,
+        # the norm's backward does not need its output so this is autograd safe
+        out = self.main(x)
+        out.add_(x)
+        return out
 
 
 class GetMatrix(nn.Module):
@@ -52,81 +70,97 @@ class GetMatrix(nn.Module):
 class NONLocalBlock2D(nn.Module):
     def __init__(self):
         super(NONLocalBlock2D, self).__init__()
-        self.g = nn.Conv2d(in_channels=1, out_channels=1,
-                           kernel_size=1, stride=1, padding=0)
 
     def forward(self, source, weight):
         """(b, c, h, w)
         src_diff: (3, 136, 32, 32)
+        return: (1, c, h, w), the b parts summed up
         """
-        batch_size = source.size(0)
+        batch_size, channel_num = source.shape[:2]
 
-        g_source = source.view(batch_size, 1, -1)  # (N, C, H*W)
-        g_source = g_source.permute(0, 2, 1)  # (N, H*W, C)
+        g_source = source.view(batch_size, channel_num, -1)  # (N, C, H*W)
 
-        y = torch.bmm(weight.to_dense(), g_source)
-        y = y.permute(0, 2, 1).contiguous()  # (N, C, H*W)
-        y = y.view(batch_size, 1, *source.size()[2:])
+        # multiply in transposed order so the result comes out as (N, C, H*W)
+        # and can be summed over the parts and viewed without a copy
+        y = torch.bmm(g_source, weight.transpose(1, 2))     # (N, C, H*W)
+        y = y.sum(dim=0, keepdim=True)
+        y = y.view(1, channel_num, *source.size()[2:])
         return y
 
 
 class Generator(nn.Module, Track):
-    """Generator. Encoder-Decoder Architecture."""
-    def __init__(self):
+    """Generator. Encoder-Decoder Architecture.
+    upsample: 'deconv' for ConvTranspose2d up-sampling as in the released models,
+        'nearest' for nearest Upsample followed by a 3x3 Conv2d, which is cheaper
+        and free of checkerboard artifacts but needs its own trained weights.
+    """
+    def __init__(self, upsample='deconv'):
         super(Generator, self).__init__()
+        assert upsample in ('deconv', 'nearest'), upsample
 
         # -------------------------- PNet(MDNet) for obtaining makeup matrices --------------------------
 
         layers = nn.Sequential(
             nn.Conv2d(3, 64, kernel_size=7, stride=1, padding=3, bias=False),
-            nn.InstanceNorm2d(64, affine=True),
+            instance_norm(64, affine=True),
             nn.ReLU(inplace=True)
         )
         self.pnet_in = layers
 
         # Down-Sampling
         curr_dim = 64
+        self.pnet_down = nn.ModuleList()
         for i in range(2):
             layers = nn.Sequential(
                 nn.Conv2d(curr_dim, curr_dim * 2, kernel_size=4, stride=2, padding=1, bias=False),
-                nn.InstanceNorm2d(curr_dim * 2, affine=True),
+                instance_norm(curr_dim * 2, affine=True),
                 nn.ReLU(inplace=True),
             )
 
-            setattr(self, f'pnet_down_{i+1}', layers)
+            self.pnet_down.append(layers)
             curr_dim = curr_dim * 2
 
         # Bottleneck. All bottlenecks share the same attention module
-        self.atten_bottleneck_g = NONLocalBlock2D()
-        self.atten_bottleneck_b = NONLocalBlock2D()
+        self.atten_bottleneck = NONLocalBlock2D()
         self.simple_spade = GetMatrix(curr_dim, 1)      # get the makeup matrix
 
-        for i in range(3):
-            setattr(self, f'pnet_bottleneck_{i+1}', ResidualBlock(dim_in=curr_dim, dim_out=curr_dim, net_mode='p'))
+        self.pnet_bottleneck = nn.ModuleList(
+            [ResidualBlock(dim_in=curr_dim, dim_out=curr_dim, net_mode='p') for i in range(3)])
 
         # --------------------------- TNet(MANet) for applying makeup transfer ----------------------------
 
         self.tnet_in_conv = nn.Conv2d(3, 64, kernel_size=7, stride=1, padding=3, bias=False)
-        self.tnet_in_spade = nn.InstanceNorm2d(64, affine=False)
+        self.tnet_in_spade = instance_norm(64, affine=False)
         self.tnet_in_relu = nn.ReLU(inplace=True)
 
         # Down-Sampling
         curr_dim = 64
+        self.tnet_down_conv = nn.ModuleList()
+        self.tnet_down_spade = nn.ModuleList()
+        self.tnet_down_relu = nn.ModuleList()
         for i in range(2):
-            setattr(self, f'tnet_down_conv_{i+1}', nn.Conv2d(curr_dim, curr_dim * 2, kernel_size=4, stride=2, padding=1, bias=False))
-            setattr(self, f'tnet_down_spade_{i+1}', nn.InstanceNorm2d(curr_dim * 2, affine=False))
-            setattr(self, f'tnet_down_relu_{i+1}', nn.ReLU(inplace=True))
+            self.tnet_down_conv.append(nn.Conv2d(curr_dim, curr_dim * 2, kernel_size=4, stride=2, padding=1, bias=False))
+            self.tnet_down_spade.append(instance_norm(curr_dim * 2, affine=False))
+            self.tnet_down_relu.append(nn.ReLU(inplace=True))
             curr_dim = curr_dim * 2
 
         # Bottleneck
-        for i in range(6):
-            setattr(self, f'tnet_bottleneck_{i+1}', ResidualBlock(dim_in=curr_dim, dim_out=curr_dim, net_mode='t'))
+        self.tnet_bottleneck = nn.ModuleList(
+            [ResidualBlock(dim_in=curr_dim, dim_out=curr_dim, net_mode='t') for i in range(6)])
 
         # Up-Sampling
+        self.tnet_up_conv = nn.ModuleList()
+        self.tnet_up_spade = nn.ModuleList()
+        self.tnet_up_relu = nn.ModuleList()
         for i in range(2):
-            setattr(self, f'tnet_up_conv_{i+1}', nn.ConvTranspose2d(curr_dim, curr_dim // 2, kernel_size=4, stride=2, padding=1, bias=False))
-            setattr(self, f'tnet_up_spade_{i+1}', nn.InstanceNorm2d(curr_dim // 2, affine=False))
-            setattr(self, f'tnet_up_relu_{i+1}', nn.ReLU(inplace=True))
+            if upsample == 'deconv':
+                self.tnet_up_conv.append(nn.ConvTranspose2d(curr_dim, curr_dim // 2, kernel_size=4, stride=2, padding=1, bias=False))
+            else:
+                self.tnet_up_conv.append(nn.Sequential(
+                    nn.Upsample(scale_factor=2, mode='nearest'),
+                    nn.Conv2d(curr_dim, curr_dim // 2, kernel_size=3, stride=1, padding=1, bias=False)))
+            self.tnet_up_spade.append(instance_norm(curr_dim // 2, affine=False))
+            self.tnet_up_relu.append(nn.ReLU(inplace=True))
             curr_dim = curr_dim // 2
 
         layers = nn.Sequential(
@@ -136,46 +170,55 @@ class Generator(nn.Module, Track):
         self.tnet_out = layers
         Track.__init__(self)
 
+    # checkpoints saved before the layers were grouped into ModuleLists
+    # name them like `pnet_down_1.0.weight` instead of `pnet_down.0.0.weight`
+    _legacy_key = re.compile(
+        r'(pnet_down|pnet_bottleneck|tnet_down_conv|tnet_down_spade|tnet_down_relu|'
+        r'tnet_bottleneck|tnet_up_conv|tnet_up_spade|tnet_up_relu)_(\d+)\.')
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for key in list(state_dict.keys()):
+            if not key.startswith(prefix):
+                continue
+            # the separate gamma/beta attention modules only held an unused conv
+            if key.startswith(('atten_bottleneck_g.', 'atten_bottleneck_b.'), len(prefix)):
+                del state_dict[key]
+                continue
+            match = self._legacy_key.match(key, len(prefix))
+            if match is None:
+                continue
+            new_key = "{}{}.{}.{}".format(
+                prefix, match.group(1), int(match.group(2)) - 1, key[match.end():])
+            state_dict[new_key] = state_dict.pop(key)
+        super(Generator, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @staticmethod
-    def atten_feature(mask_s, weight, gamma_s, beta_s, atten_module_g, atten_module_b):
+    def atten_feature(mask_s_re, weight, gamma_s, beta_s, atten_module):
         """
         feature size: (1, c, h, w)
-        mask_c(s): (3, 1, h, w)
+        mask_c(s)_re: (3, 1, h, w), masks resized to the feature size
         diff_c: (1, 138, 256, 256)
         return: (1, c, h, w)
         """
         channel_num = gamma_s.shape[1]
+        # gamma and beta share the weight, attend to both in a single bmm
+        source = torch.cat((gamma_s, beta_s), dim=1) * mask_s_re  # (3, 2c, h, w) broadcast over parts
 
-        mask_s_re = F.interpolate(mask_s, size=gamma_s.shape[2:]).repeat(1, channel_num, 1, 1)
-        gamma_s_re = gamma_s.repeat(3, 1, 1, 1)
-        gamma_s = gamma_s_re * mask_s_re  # (3, c, h, w)
-        beta_s_re = beta_s.repeat(3, 1, 1, 1)
-        beta_s = beta_s_re * mask_s_re
+        y = atten_module(source, weight)  # (1, 2c, h, w) the three parts combined
+        return y[:, :channel_num], y[:, channel_num:]
 
-        gamma = atten_module_g(gamma_s, weight)  # (3, c, h, w)
-        beta = atten_module_b(beta_s, weight)
-
-        gamma = (gamma[0] + gamma[1] + gamma[2]).unsqueeze(0)  # (c, h, w) combine the three parts
-        beta = (beta[0] + beta[1] + beta[2]).unsqueeze(0)
-        return gamma, beta
-
-    def get_weight(self, mask_c, mask_s, fea_c, fea_s, diff_c, diff_s):
+    def get_atten_input(self, mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s):
         """  s --> source; c --> target
         feature size: (1, 256, 64, 64)
+        mask_re: (3, 1, 64, 64)
         diff: (3, 136, 32, 32)
+        return: theta_target (3, HW, C+136), phi_source (3, C+136, HW)
         """
         HW = 64 * 64
         batch_size = 3
         assert fea_s is not None   # fea_s when i==3
-        # get 3 part fea using mask
-        channel_num = fea_s.shape[1]
-
-        mask_c_re = F.interpolate(mask_c, size=64).repeat(1, channel_num, 1, 1)  # (3, c, h, w)
-        fea_c = fea_c.repeat(3, 1, 1, 1)                 # (3, c, h, w)
+        # get 3 part fea using mask, broadcast over channels and parts
         fea_c = fea_c * mask_c_re                        # (3, c, h, w) 3 stands for 3 parts
-
-        mask_s_re = F.interpolate(mask_s, size=64).repeat(1, channel_num, 1, 1)
-        fea_s = fea_s.repeat(3, 1, 1, 1)
         fea_s = fea_s * mask_s_re
 
         theta_input = torch.cat((fea_c * 0.01, diff_c), dim=1)
@@ -185,23 +228,68 @@ class Generator(nn.Module, Track):
         theta_target = theta_target.permute(0, 2, 1)        # (N, H*W, C+136)
 
         phi_source = phi_input.view(batch_size, -1, HW)     # (N, C+136, H*W)
+        return theta_target, phi_source
+
+    def get_weight(self, mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s):
+        """  s --> source; c --> target
+        feature size: (1, 256, 64, 64)
+        mask_re: (3, 1, 64, 64)
+        diff: (3, 136, 32, 32)
+        """
+        theta_target, phi_source = self.get_atten_input(mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s)
+        # hyper parameters for visual feature, applied to the (3, HW, C+136) input
+        # rather than the 16x larger (3, HW, HW) product
+        theta_target = theta_target * 200
         self.track("before mask")
 
         weight = torch.bmm(theta_target, phi_source)        # (3, HW, HW)
         self.track("among bmm")
-        with torch.no_grad():
-            v = weight.detach().nonzero().long().permute(1, 0)
-            # This clone is required to correctly release cuda memory.
-            weight_ind = v.clone()
-            del v
-            torch.cuda.empty_cache()
-
-        weight *= 200                                       # hyper parameters for visual feature
+        # entries with zero similarity (outside the part masks) are dropped
+        # after softmax, all on device instead of a sparse round-trip via cpu
+        zero_ind = weight == 0
+
         weight = F.softmax(weight, dim=-1)
-        weight = weight[weight_ind[0], weight_ind[1], weight_ind[2]]
-        ret = torch.sparse.FloatTensor(weight_ind, weight, torch.Size([3, HW, HW]))
+        weight = weight.masked_fill(zero_ind, 0)
         self.track("after bmm")
-        return ret
+        return weight
+
+    def atten_feature_sdpa(self, mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s, gamma_s, beta_s):
+        """get_weight and atten_feature in one scaled_dot_product_attention,
+        so the (3, HW, HW) weight is never materialized.
+        feature size: (1, c, h, w)
+        return: (1, c, h, w)
+        """
+        theta_target, phi_source = self.get_atten_input(mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s)
+        channel_num = gamma_s.shape[1]
+
+        value = torch.cat((gamma_s, beta_s), dim=1) * mask_s_re           # (3, 2c, h, w)
+        value = value.view(3, 2 * channel_num, -1).permute(0, 2, 1)       # (3, HW, 2c)
+        # the memory-efficient kernel needs head dims aligned to 8, without the
+        # zero padding a 2 wide value falls back to the math kernel and its full weight
+        value = F.pad(value, (0, -value.shape[-1] % 8))                   # (3, HW, 8)
+
+        # fused kernels want (N, heads, L, E) inputs with a unit stride last dim
+        query = theta_target.contiguous().unsqueeze(1)                    # (3, 1, HW, C+136)
+        key = phi_source.permute(0, 2, 1).contiguous().unsqueeze(1)       # (3, 1, HW, C+136)
+        y = F.scaled_dot_product_attention(
+            query, key, value.contiguous().unsqueeze(1), scale=200).squeeze(1)
+        y = y[..., :2 * channel_num]                                      # (3, HW, 2c)
+        # target pixels outside a part have an all-zero weight row in get_weight
+        y = y * theta_target.ne(0).any(dim=-1, keepdim=True)
+        y = y.sum(dim=0).permute(1, 0).reshape(1, 2 * channel_num, *gamma_s.shape[2:])
+        self.track("after attention")
+        return y[:, :channel_num], y[:, channel_num:]
+
+    def makeup_matrices(self, mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s, gamma_s, beta_s):
+        """Attend the source makeup matrices to the target, in fp32.
+        feature size: (1, c, h, w)
+        return: (1, c, h, w)
+        """
+        fea_c, fea_s, gamma_s, beta_s = [x.float() for x in (fea_c, fea_s, gamma_s, beta_s)]
+        if _USE_SDPA:
+            return self.atten_feature_sdpa(mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s, gamma_s, beta_s)
+        weight = self.get_weight(mask_c_re, mask_s_re, fea_c, fea_s, diff_c, diff_s)
+        return self.atten_feature(mask_s_re, weight, gamma_s, beta_s, self.atten_bottleneck)
 
     def forward(self, c, s, mask_c, mask_s, diff_c, diff_s, gamma=None, beta=None, ret=False):
         c, s, mask_c, mask_s, diff_c, diff_s = [x.squeeze(0) if x.ndim == 5 else x for x in [c, s, mask_c, mask_s, diff_c, diff_s]]
@@ -214,36 +302,36 @@ class Generator(nn.Module, Track):
         self.track("start")
         # forward c in tnet(MANet)
         c_tnet = self.tnet_in_conv(c)
-        s = self.pnet_in(s)
+        if gamma is None:               # pnet only runs when makeup matrices are not given
+            s = self.pnet_in(s)
         c_tnet = self.tnet_in_spade(c_tnet)
         c_tnet = self.tnet_in_relu(c_tnet)
 
         # down-sampling
         for i in range(2):
             if gamma is None:
-                cur_pnet_down = getattr(self, f'pnet_down_{i+1}')
-                s = cur_pnet_down(s)
-
-            cur_tnet_down_conv = getattr(self, f'tnet_down_conv_{i+1}')
-            cur_tnet_down_spade = getattr(self, f'tnet_down_spade_{i+1}')
-            cur_tnet_down_relu = getattr(self, f'tnet_down_relu_{i+1}')
-            c_tnet = cur_tnet_down_conv(c_tnet)
-            c_tnet = cur_tnet_down_spade(c_tnet)
-            c_tnet = cur_tnet_down_relu(c_tnet)
+                s = self.pnet_down[i](s)
+
+            c_tnet = self.tnet_down_conv[i](c_tnet)
+            c_tnet = self.tnet_down_spade[i](c_tnet)
+            c_tnet = self.tnet_down_relu[i](c_tnet)
         self.track("downsampling")
 
         # bottleneck
         for i in range(6):
-            if gamma is None and i <= 2:
-                cur_pnet_bottleneck = getattr(self, f'pnet_bottleneck_{i+1}')
-            cur_tnet_bottleneck = getattr(self, f'tnet_bottleneck_{i+1}')
-
             # get s_pnet from p and transform
             if i == 3:
                 if gamma is None:               # not in test_mix
                     s, gamma, beta = self.simple_spade(s)
-                    weight = self.get_weight(mask_c, mask_s, c_tnet, s, diff_c, diff_s)
-                    gamma, beta = self.atten_feature(mask_s, weight, gamma, beta, self.atten_bottleneck_g, self.atten_bottleneck_b)
+                    # resize the part masks once for both the weight and the makeup matrices
+                    mask_c_re = F.interpolate(mask_c, size=c_tnet.shape[2:])  # (3, 1, h, w)
+                    mask_s_re = F.interpolate(mask_s, size=s.shape[2:])
+                    if hasattr(torch, "autocast"):
+                        # the x200 similarities need fp32 logits, keep the attention out of autocast
+                        with torch.autocast(c_tnet.device.type, enabled=False):
+                            gamma, beta = self.makeup_matrices(mask_c_re, mask_s_re, c_tnet, s, diff_c, diff_s, gamma, beta)
+                    else:
+                        gamma, beta = self.makeup_matrices(mask_c_re, mask_s_re, c_tnet, s, diff_c, diff_s, gamma, beta)
                     if ret:
                         return [gamma, beta]
                 # else:                       # in test mode
@@ -252,18 +340,15 @@ class Generator(nn.Module, Track):
                 c_tnet = c_tnet * (1 + gamma) + beta    # apply makeup transfer using makeup matrices
 
             if gamma is None and i <= 2:
-                s = cur_pnet_bottleneck(s)
-            c_tnet = cur_tnet_bottleneck(c_tnet)
+                s = self.pnet_bottleneck[i](s)
+            c_tnet = self.tnet_bottleneck[i](c_tnet)
         self.track("bottleneck")
 
         # up-sampling
         for i in range(2):
-            cur_tnet_up_conv = getattr(self, f'tnet_up_conv_{i+1}')
-            cur_tnet_up_spade = getattr(self, f'tnet_up_spade_{i+1}')
-            cur_tnet_up_relu = getattr(self, f'tnet_up_relu_{i+1}')
-            c_tnet = cur_tnet_up_conv(c_tnet)
-            c_tnet = cur_tnet_up_spade(c_tnet)
-            c_tnet = cur_tnet_up_relu(c_tnet)
+            c_tnet = self.tnet_up_conv[i](c_tnet)
+            c_tnet = self.tnet_up_spade[i](c_tnet)
+            c_tnet = self.tnet_up_relu[i](c_tnet)
         self.track("upsampling")
 
         c_tnet = self.tnet_out(c_tnet)
@@ -401,6 +486,12 @@ def make_layers(cfg, batch_norm=False):
     return nn.Sequential(*layers)
 
 
+# torchvision >= 0.13 no longer exports model_urls from torchvision.models.vgg
+model_urls = {
+    'vgg16': 'https://download.pytorch.org/models/vgg16-397923af.pth',
+}
+
+
 def _vgg(arch, cfg, batch_norm, pretrained, progress, **kwargs):
     if pretrained:
         kwargs['init_weights'] = False
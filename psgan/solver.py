@@ -6,6 +6,7 @@ pwd = osp.split(osp.realpath(__file__))[0]
 
 import time
 import datetime
+from contextlib import ExitStack
 
 import torch
 from torch import nn
@@ -25,10 +26,27 @@ from concern.track import Track
 
 class Solver(Track):
     def __init__(self, config, device="cpu", data_loader=None, inference=False):
-        self.G = net.Generator()
+        self.G = net.Generator(upsample=config.MODEL.G_UPSAMPLE)
+        self.amp = False
+        self.cuda_graph = False
+        self.channels_last = False
         if inference:
             self.G.load_state_dict(torch.load(inference, map_location=torch.device(device)))
             self.G = self.G.to(device).eval()
+            self.channels_last = torch.device(device).type == "cuda"
+            if self.channels_last:
+                # nhwc lets cudnn pick its tensor core conv kernels
+                self.G = self.G.to(memory_format=torch.channels_last)
+            self.amp = config.INFERENCE.AMP and hasattr(torch, "autocast") \
+                and torch.device(device).type == "cuda" and torch.cuda.is_bf16_supported()
+            if config.INFERENCE.COMPILE and hasattr(torch, "compile") \
+                    and torch.device(device).type == "cuda":
+                # let inductor fuse the conv/norm/relu chains and replay them as cuda graphs
+                self.G = torch.compile(self.G, backend="inductor", mode="reduce-overhead")
+            else:
+                self.cuda_graph = config.INFERENCE.CUDA_GRAPH and hasattr(torch.cuda, "graph") \
+                    and torch.device(device).type == "cuda"
+                self.graph = None
             return
 
         self.start_time = time.time()
@@ -164,14 +182,58 @@ class Solver(Track):
     # mask attribute: 0:background 1:face 2:left-eyebrown 3:right-eyebrown 4:left-eye 5: right-eye 6: nose
     # 7: upper-lip 8: teeth 9: under-lip 10:hair 11: left-ear 12: right-ear 13: neck
 
+    def transfer(self, real_A, mask_A, diff_A, real_B, mask_B, diff_B):
+        cur_prama = self.generate(real_A, real_B, None, None, mask_A, mask_B, 
+                                  diff_A, diff_B, ret=True)
+        fake_A = self.generate(real_A, real_B, None, None, mask_A, mask_B, 
+                               diff_A, diff_B, gamma=cur_prama[0], beta=cur_prama[1])
+        return fake_A
+
+    def transfer_graphed(self, *inputs):
+        """Run `transfer` by replaying a cuda graph captured for the input layout."""
+        # the graph reads fixed buffers, re-capture whenever their layout would differ
+        layout = [(x.shape, x.dtype, x.device, x.stride()) for x in inputs]
+        if self.graph is None or self.graph_layout != layout:
+            self.graph_inputs = [x.clone() for x in inputs]
+            # warm up on a side stream before capturing, as required by cuda graphs
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.transfer(*self.graph_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            # tracking synchronizes the device, which is not allowed while capturing
+            enable_track, self.G.enable_track = self.G.enable_track, False
+            try:
+                self.graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(self.graph):
+                    self.graph_output = self.transfer(*self.graph_inputs)
+            finally:
+                self.G.enable_track = enable_track
+            self.graph_layout = layout
+
+        for graph_input, x in zip(self.graph_inputs, inputs):
+            graph_input.copy_(x)
+        self.graph.replay()
+        return self.graph_output.clone()
+
     def test(self, real_A, mask_A, diff_A, real_B, mask_B, diff_B):
-        cur_prama = None
-        with torch.no_grad():
-            cur_prama = self.generate(real_A, real_B, None, None, mask_A, mask_B, 
-                                      diff_A, diff_B, ret=True)
-            fake_A = self.generate(real_A, real_B, None, None, mask_A, mask_B, 
-                                   diff_A, diff_B, gamma=cur_prama[0], beta=cur_prama[1])
-        fake_A = fake_A.squeeze(0)
+        if self.channels_last:
+            real_A = real_A.contiguous(memory_format=torch.channels_last)
+            real_B = real_B.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad(), ExitStack() as stack:
+            if self.amp:
+                # The generator keeps its attention stage in fp32.
+                # Autocast itself keeps softmax and norm statistics in fp32.
+                # Its weight cache must be off while capturing a cuda graph.
+                stack.enter_context(torch.autocast(
+                    "cuda", dtype=torch.bfloat16, cache_enabled=not self.cuda_graph))
+            if self.cuda_graph:
+                fake_A = self.transfer_graphed(real_A, mask_A, diff_A, real_B, mask_B, diff_B)
+            else:
+                fake_A = self.transfer(real_A, mask_A, diff_A, real_B, mask_B, diff_B)
+        fake_A = fake_A.squeeze(0).float()
 
         # normalize
         min_, max_ = fake_A.min(), fake_A.max()
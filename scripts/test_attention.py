@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from psgan import net
+
+
+def make_inputs(device="cpu", channel_num=256, size=64, seed=0):
+    """Random bottleneck features with part masks and diffs laid out like PreProcess."""
+    torch.manual_seed(seed)
+    inputs = {}
+    for side in ("c", "s"):
+        parts = torch.randint(0, 4, (1, 1, size, size), device=device)
+        mask = torch.cat([(parts == i).float() for i in (1, 2, 3)], 0)   # (3, 1, h, w)
+        diff = torch.randn(1, 136, size, size, device=device).repeat(3, 1, 1, 1) * mask
+        norm = torch.norm(diff, dim=1, keepdim=True)
+        norm[norm == 0] = 1e10
+        inputs["mask_" + side] = mask
+        inputs["diff_" + side] = diff / norm
+        inputs["fea_" + side] = torch.randn(1, channel_num, size, size, device=device)
+    inputs["gamma_s"] = torch.randn(1, 1, size, size, device=device)
+    inputs["beta_s"] = torch.randn(1, 1, size, size, device=device)
+    return inputs
+
+
+def atten_bmm(G, x):
+    weight = G.get_weight(x["mask_c"], x["mask_s"], x["fea_c"], x["fea_s"], x["diff_c"], x["diff_s"])
+    return G.atten_feature(x["mask_s"], weight, x["gamma_s"], x["beta_s"], G.atten_bottleneck)
+
+
+def atten_sdpa(G, x):
+    return G.atten_feature_sdpa(x["mask_c"], x["mask_s"], x["fea_c"], x["fea_s"],
+                                x["diff_c"], x["diff_s"], x["gamma_s"], x["beta_s"])
+
+
+def efficient_attention_only():
+    """Disable every SDPA backend but the memory-efficient one."""
+    try:
+        from torch.nn.attention import sdpa_kernel, SDPBackend
+        return sdpa_kernel(SDPBackend.EFFICIENT_ATTENTION)
+    except ImportError:
+        return torch.backends.cuda.sdp_kernel(
+            enable_flash=False, enable_math=False, enable_mem_efficient=True)
+
+
+def test_sdpa_matches_bmm():
+    """The scaled_dot_product_attention path equals get_weight + atten_feature."""
+    if not net._USE_SDPA:
+        pytest.skip("scaled_dot_product_attention needs torch >= 2.1")
+    G = net.Generator().eval()
+    x = make_inputs()
+    with torch.no_grad():
+        gamma_bmm, beta_bmm = atten_bmm(G, x)
+        gamma_sdpa, beta_sdpa = atten_sdpa(G, x)
+    assert torch.allclose(gamma_bmm, gamma_sdpa, rtol=1e-3, atol=1e-4)
+    assert torch.allclose(beta_bmm, beta_sdpa, rtol=1e-3, atol=1e-4)
+
+
+def test_sdpa_uses_fused_kernel():
+    """On cuda the attention runs with the math fallback disabled,
+    i.e. without materializing the (3, HW, HW) weight."""
+    if not net._USE_SDPA:
+        pytest.skip("scaled_dot_product_attention needs torch >= 2.1")
+    if not torch.cuda.is_available():
+        pytest.skip("the fused sdpa kernels need cuda")
+    G = net.Generator().cuda().eval()
+    x = make_inputs("cuda")
+    with torch.no_grad():
+        gamma_bmm, beta_bmm = atten_bmm(G, x)
+        with efficient_attention_only():
+            gamma_sdpa, beta_sdpa = atten_sdpa(G, x)
+    assert torch.allclose(gamma_bmm, gamma_sdpa, rtol=1e-3, atol=1e-4)
+    assert torch.allclose(beta_bmm, beta_sdpa, rtol=1e-3, atol=1e-4)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-rs"])